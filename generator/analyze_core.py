@@ -0,0 +1,73 @@
+"""
+Per-ply loop of `Generator.analyze_game`. Everything here is annotated and free of I/O
+so that it can be compiled with mypyc (see README), it is used as plain python otherwise.
+"""
+from __future__ import annotations
+
+import chess
+
+from chess import Board, Color
+from chess.engine import Cp, PovScore, Score
+from model import Mainline, Puzzle
+from typing import TYPE_CHECKING, Dict, Hashable, Iterator, Optional, Set, Tuple, Union
+from util import material_change, material_count, maximum_castling_rights, score_key
+
+if TYPE_CHECKING:
+    from generator import Generator
+
+Candidate = Tuple[Board, Score, PovScore, int]
+
+def candidate_positions(generator: Generator, mainline: Mainline) -> Iterator[Candidate]:
+    """
+    Positions of the mainline worth a `Generator.analyze_position`, with the previous score, the eval
+    and the material difference it takes. The board is the one being played on, it is only valid until the next one.
+    Those are independent of what `analyze_position` finds: when it finds no puzzle its result is the eval.
+    """
+    assert mainline.board
+    prev_score: Score = Cp(20)
+    seen_positions: Set[Hashable] = set()
+    board: Board = mainline.board.copy()
+    skip_until_irreversible: bool = False
+    # kept up to date move by move rather than counted on every position
+    material: Dict[Color, int] = { chess.WHITE: material_count(board, chess.WHITE), chess.BLACK: material_count(board, chess.BLACK) }
+
+    for move, current_eval, key in mainline.moves:
+        won, lost = material_change(board, move)
+        material[board.turn] += won
+        material[not board.turn] -= lost
+
+        if skip_until_irreversible:
+            if board.is_irreversible(move):
+                skip_until_irreversible = False
+                seen_positions.clear()
+            else:
+                board.push(move)
+                continue
+
+        board.push(move)
+        position: Hashable = board._transposition_key()
+        if position in seen_positions:
+            skip_until_irreversible = True
+            continue
+        seen_positions.add(position)
+
+        if board.castling_rights != maximum_castling_rights(board):
+            continue
+
+        if not current_eval or key is None:
+            current_eval = generator.compute_eval(board)
+            key = score_key(current_eval.relative)
+
+        # `analyze_position` never probes a position worth less than +2 for the side to move
+        if key >= 200:
+            yield board, prev_score, current_eval, material[board.turn] - material[not board.turn]
+
+        prev_score = -current_eval.relative
+
+def analyze_mainline(generator: Generator, mainline: Mainline, tier: int) -> Optional[Puzzle]:
+    site: str = mainline.headers.get("Site", "?")
+    for board, prev_score, current_eval, material in candidate_positions(generator, mainline):
+        result: Union[Puzzle, Score] = generator.analyze_position(board, prev_score, current_eval, tier, material, site)
+        if isinstance(result, Puzzle):
+            return result
+    return None
@@ -3,20 +3,30 @@ import argparse
 import chess
 import chess.pgn
 import chess.engine
-import copy
 import sys
 import util
 import csv
-from model import Puzzle, NextMovePair
-
+import io
+import multiprocessing
+import multiprocessing.util
+import shutil
+import subprocess
+from analyze_core import analyze_mainline, candidate_positions
+from model import Mainline, Puzzle, NextMovePair, ProbeNode
+
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from io import StringIO
 from chess import Move, Color, Board
 from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
-from chess.pgn import Game, ChildNode
+from chess.pgn import ChildNode, Game, Headers
 
+from multiprocessing.sharedctypes import Synchronized
+from multiprocessing.synchronize import Lock
 from pathlib import Path
-from typing import List, Optional, Union, Set
-from util import count_mates, get_next_move_pair, material_count, material_diff, is_up_in_material, maximum_castling_rights, win_chances
+from queue import Queue
+from typing import Deque, Iterator, List, MutableMapping, Optional, TextIO, Tuple, Union, Set
+from util import at_least_two_legal, get_next_move_pair, material_count, material_diff, non_mating_moves, parse_eval, score_key, win_chances, TranspositionTable
 
 version = "48WC9" # Was made for the World Championship first
 
@@ -25,16 +35,43 @@ logging.basicConfig(format='%(asctime)s %(levelname)-4s %(message)s', datefmt='%
 
 eval_limit = chess.engine.Limit(depth = 15, time = 30, nodes = 10_000_000) # when the move isn't analysed
 pair_limit = chess.engine.Limit(depth = 50, time = 30, nodes = 30_000_000)
+# iterative deepening of attacking moves, the last step being the full `pair_limit` so that an attack
+# settling only there is judged as without deepening. The engine hash table is kept between the steps
+pair_limits = [
+    chess.engine.Limit(depth = 20, time = 3, nodes = 2_000_000),
+    chess.engine.Limit(depth = 35, time = 7, nodes = 10_000_000),
+    pair_limit,
+]
 mate_defense_limit = chess.engine.Limit(depth = 15, time = 10, nodes = 10_000_000)
+mate_defense_check_limit = chess.engine.Limit(depth = 8, time = 10, nodes = 1_000_000) # when the defense is already known
 
 mate_soon = Mate(15)
+# games between two saves of the persistent cache, so that a crash does not lose the whole run
+cache_snapshot_interval = 1000
+
+def puzzle_node(board: Board) -> ChildNode:
+    """
+    Node of the last move of `board`, `post` needs its parent for the position of the puzzle
+    """
+    node = Game.from_board(board).end()
+    assert isinstance(node, ChildNode)
+    return node
 
 class Generator:
-    def __init__(self, engine: SimpleEngine):
+    def __init__(self, engine: Optional[SimpleEngine], tt: Optional[TranspositionTable] = None, probes: Optional["ProbePool"] = None):
+        # none when all the analysis is done by `probes`
         self.engine = engine
+        self.tt = tt if tt is not None else TranspositionTable()
         self.not_analysed_warning = False
+        # engines probing the candidate positions of a game concurrently, `engine` does it otherwise
+        self.probes = probes
 
-    def is_valid_mate_in_one(self, pair: NextMovePair) -> bool:
+    @property
+    def analysis_engine(self) -> SimpleEngine:
+        assert self.engine is not None, "a generator without engine hands its games to its probes"
+        return self.engine
+
+    def is_valid_mate_in_one(self, pair: NextMovePair, board: Board) -> bool:
         if pair.best.score != Mate(1):
             return False
         non_mate_win_threshold = 0.6
@@ -43,180 +80,179 @@ class Generator:
         if pair.second.score == Mate(1):
             # if there's more than one mate in one, gotta look if the best non-mating move is bad enough
             logger.debug('Looking for best non-mating move...')
-            mates = count_mates(copy.deepcopy(pair.node.board()))
-            info = self.engine.analyse(pair.node.board(), multipv = mates + 1, limit = pair_limit)
-            scores =  [pv["score"].pov(pair.winner) for pv in info]
-            # the first non-matein1 move is the last element
-            if scores[-1] < Mate(1) and win_chances(scores[-1]) > non_mate_win_threshold:
+            moves = non_mating_moves(board)
+            if not moves:
+                return True
+            # searching only the non-mating moves, instead of one more line than there are mates
+            info = self.analysis_engine.analyse(board, limit = pair_limit, root_moves = moves)
+            score = info["score"].pov(pair.winner)
+            if score < Mate(1) and win_chances(score) > non_mate_win_threshold:
                     return False
             return True
         return False
 
     # is pair.best the only continuation?
-    def is_valid_attack(self, pair: NextMovePair) -> bool:
+    def is_valid_attack(self, pair: NextMovePair, board: Board) -> bool:
         return (
             pair.second is None or
-            self.is_valid_mate_in_one(pair) or
+            self.is_valid_mate_in_one(pair, board) or
             win_chances(pair.best.score) > win_chances(pair.second.score) + 0.7
         )
 
-    def get_next_pair(self, node: ChildNode, winner: Color) -> Optional[NextMovePair]:
-        pair = get_next_move_pair(self.engine, node, winner, pair_limit)
-        if node.board().turn == winner and not self.is_valid_attack(pair):
-            logger.debug("No valid attack {}".format(pair))
+    def get_next_pair(self, board: Board, winner: Color, good_enough: Score) -> Optional[NextMovePair]:
+        if board.turn != winner:
+            return get_next_move_pair(self.analysis_engine, board, winner, pair_limit, self.tt)
+        # a shallow search is enough once the attack is clearly the only one and `good_enough` for the caller,
+        # deeper searches reuse the engine hash table filled by the previous ones
+        for limit in pair_limits:
+            pair = get_next_move_pair(self.analysis_engine, board, winner, limit, self.tt)
+            valid = self.is_valid_attack(pair, board)
+            if valid and pair.best.score >= good_enough:
+                break
+            if pair.second and pair.best.score.is_mate() and pair.second.score.is_mate():
+                break
+        if not valid:
+            logger.debug("No valid attack %s", pair)
             return None
         return pair
 
-    def get_next_move(self, node: ChildNode, limit: chess.engine.Limit) -> Optional[Move]:
-        result = self.engine.play(node.board(), limit = limit)
+    def get_next_move(self, board: Board, limit: chess.engine.Limit) -> Optional[Move]:
+        result = self.analysis_engine.play(board, limit = limit)
         return result.move if result else None
 
-    def cook_mate(self, node: ChildNode, winner: Color) -> Optional[List[Move]]:
-
-        board = node.board()
-
-        if board.is_game_over():
-            return []
+    def get_mate_defense(self, board: Board, winner: Color, expected: Optional[Move]) -> Optional[Move]:
+        if expected is not None:
+            # the attacker's principal variation already holds the defense, a small search confirming it is enough
+            info = self.analysis_engine.analyse(board, limit = mate_defense_check_limit)
+            mate = info["score"].pov(winner).mate()
+            if info.get("pv") and info["pv"][0] == expected and mate is not None and mate > 0:
+                return expected
+        return self.get_next_move(board, mate_defense_limit)
+
+    def cook_mate(self, node: ProbeNode, winner: Color) -> Optional[List[Move]]:
+
+        board = node.board
+        pair: Optional[NextMovePair] = None
+
+        while not board.is_game_over():
+            if board.turn == winner:
+                pair = self.get_next_pair(board, winner, mate_soon)
+                if not pair:
+                    return None
+                if pair.best.score < mate_soon:
+                    logger.debug("Best move is not a mate, we're probably not searching deep enough")
+                    return None
+                move = pair.best.move
+            else:
+                next = self.get_mate_defense(board, winner, pair.expected_reply if pair else None)
+                if not next:
+                    return None
+                move = next
+            node.add_main_variation(move)
+
+        return node.moves
+
+
+    def cook_advantage(self, node: ProbeNode, winner: Color) -> Optional[List[NextMovePair]]:
+
+        board = node.board
+        solution: List[NextMovePair] = []
+
+        while True:
+            if node.is_repetition(2):
+                logger.debug("Found repetition, canceling")
+                return None
 
-        if board.turn == winner:
-            pair = self.get_next_pair(node, winner)
+            pair = self.get_next_pair(board, winner, Cp(200))
             if not pair:
+                return solution
+            if pair.best.score < Cp(200):
+                logger.debug("Not winning enough, aborting")
                 return None
-            if pair.best.score < mate_soon:
-                logger.debug("Best move is not a mate, we're probably not searching deep enough")
-                return None
-            move = pair.best.move
-        else:
-            next = self.get_next_move(node, mate_defense_limit)
-            if not next:
-                return None
-            move = next
-
-        follow_up = self.cook_mate(node.add_main_variation(move), winner)
-
-        if follow_up is None:
-            return None
-
-        return [move] + follow_up
-
-
-    def cook_advantage(self, node: ChildNode, winner: Color) -> Optional[List[NextMovePair]]:
-
-        board = node.board()
-
-        if board.is_repetition(2):
-            logger.debug("Found repetition, canceling")
-            return None
-
-        pair = self.get_next_pair(node, winner)
-        if not pair:
-            return []
-        if pair.best.score < Cp(200):
-            logger.debug("Not winning enough, aborting")
-            return None
-
-        follow_up = self.cook_advantage(node.add_main_variation(pair.best.move), winner)
-
-        if follow_up is None:
-            return None
-
-        return [pair] + follow_up
-
 
-    def analyze_game(self, game: Game, tier: int) -> Optional[Puzzle]:
+            solution.append(pair)
+            node.add_main_variation(pair.best.move)
 
-        logger.debug(f'Analyzing tier {tier} {game.headers.get("Site")}...')
 
-        prev_score: Score = Cp(20)
-        seen_epds: Set[str] = set()
-        board = game.board()
-        skip_until_irreversible = False
+    def analyze_game(self, game: Mainline, tier: int) -> Optional[Puzzle]:
 
-        for node in game.mainline():
-            if skip_until_irreversible:
-                if board.is_irreversible(node.move):
-                    skip_until_irreversible = False
-                    seen_epds.clear()
-                else:
-                    board.push(node.move)
-                    continue
+        logger.debug("Analyzing tier %s %s...", tier, game.headers.get("Site"))
 
-            current_eval = node.eval()
+        puzzle = analyze_mainline(self, game, tier) if self.probes is None else self.probes.analyze_mainline(self, game, tier)
+        if puzzle is not None:
+            return puzzle
 
-            if not current_eval:
-                if not self.not_analysed_warning:
-                    logger.warning("Game not already analysed by stockfish, will make one but consider using already analysed games from Lichess")
-                    self.not_analysed_warning = True
-                logger.debug("Move without eval on ply {}, computing...".format(node.ply()))
-                current_eval = self.engine.analyse(node.board(), eval_limit)["score"]
-
-            board.push(node.move)
-            epd = board.epd()
-            if epd in seen_epds:
-                skip_until_irreversible = True
-                continue
-            seen_epds.add(epd)
-
-            if board.castling_rights != maximum_castling_rights(board):
-                continue
-
-            result = self.analyze_position(node, prev_score, current_eval, tier)
-
-            if isinstance(result, Puzzle):
-                return result
-
-            prev_score = -result
-
-        logger.debug("Found nothing from {}".format(game.headers.get("Site")))
+        logger.debug("Found nothing from %s", game.headers.get("Site"))
 
         return None
 
 
-    def analyze_position(self, node: ChildNode, prev_score: Score, current_eval: PovScore, tier: int) -> Union[Puzzle, Score]:
+    def compute_eval(self, board: Board) -> PovScore:
+        if not self.not_analysed_warning:
+            logger.warning("Game not already analysed by stockfish, will make one but consider using already analysed games from Lichess")
+            self.not_analysed_warning = True
+        logger.debug("Move without eval on ply %s, computing...", board.ply())
+        if self.probes is not None:
+            return self.probes.compute_eval(board)
+        return self.analysis_engine.analyse(board, eval_limit)["score"]
+
 
-        board = node.board()
+    def analyze_position(self, board: Board, prev_score: Score, current_eval: PovScore, tier: int, material: Optional[int] = None, game_url: str = "?") -> Union[Puzzle, Score]:
+        """
+        `board` is the position after the move to be analysed, probes play on it and take their moves back
+        """
         winner = board.turn
         score = current_eval.pov(winner)
+        # material difference from the winner point of view, counted from the board if not given
+        diff = material_diff(board, winner) if material is None else material
 
-        if board.legal_moves.count() < 2:
+        if not at_least_two_legal(board):
             return score
 
-        game_url = node.game().headers.get("Site")
+        ply = board.ply()
 
-        logger.debug("{} {} to {}".format(node.ply(), node.move.uci() if node.move else None, score))
+        logger.debug("%s %s to %s", ply, board.peek() if board.move_stack else None, score)
 
         if prev_score > Cp(300) and score < mate_soon:
-            logger.debug("{} Too much of a winning position to start with {} -> {}".format(node.ply(), prev_score, score))
+            logger.debug("%s Too much of a winning position to start with %s -> %s", ply, prev_score, score)
             return score
-        if is_up_in_material(board, winner):
-            logger.debug("{} already up in material {} {} {}".format(node.ply(), winner, material_count(board, winner), material_count(board, not winner)))
+        if diff > 0:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s already up in material %s %s %s", ply, winner, material_count(board, winner), material_count(board, not winner))
             return score
         elif score >= Mate(1) and tier < 3:
-            logger.debug("{} mate in one".format(node.ply()))
+            logger.debug("%s mate in one", ply)
             return score
         elif score > mate_soon:
-            logger.debug("Mate {}#{} Probing...".format(game_url, node.ply()))
+            logger.debug("Mate %s#%s Probing...", game_url, ply)
             '''
             if self.server.is_seen_pos(node):
                 logger.debug("Skip duplicate position")
                 return score
             '''
-            mate_solution = self.cook_mate(copy.deepcopy(node), winner)
+            probe = ProbeNode(board)
+            try:
+                mate_solution = self.cook_mate(probe, winner)
+            finally:
+                probe.unwind()
             if mate_solution is None or (tier == 1 and len(mate_solution) == 3):
                 return score
-            return Puzzle(node, mate_solution, 999999999, node.game().headers.get("Site", "?")[20:])
+            return Puzzle(puzzle_node(board), mate_solution, 999999999, game_url[20:])
         elif score >= Cp(200) and win_chances(score) > win_chances(prev_score) + 0.6:
-            if score < Cp(400) and material_diff(board, winner) > -1:
+            if score < Cp(400) and diff > -1:
                 logger.debug("Not clearly winning and not from being down in material, aborting")
                 return score
-            logger.debug("Advantage {}#{} {} -> {}. Probing...".format(game_url, node.ply(), prev_score, score))
+            logger.debug("Advantage %s#%s %s -> %s. Probing...", game_url, ply, prev_score, score)
             '''
             if self.server.is_seen_pos(node):
                 logger.debug("Skip duplicate position")
                 return score
             '''
-            puzzle_node = copy.deepcopy(node)
-            solution : Optional[List[NextMovePair]] = self.cook_advantage(puzzle_node, winner)
+            probe = ProbeNode(board)
+            try:
+                solution : Optional[List[NextMovePair]] = self.cook_advantage(probe, winner)
+            finally:
+                probe.unwind()
             #self.server.set_seen(node.game())
             if not solution:
                 return score
@@ -231,11 +267,66 @@ class Generator:
                 logger.debug("Discard two-mover")
                 return score
             cp = solution[len(solution) - 1].best.score.score()
-            return Puzzle(node, [p.best.move for p in solution], 999999998 if cp is None else cp, node.game().headers.get("Site", "?")[20:])
+            return Puzzle(puzzle_node(board), [p.best.move for p in solution], 999999998 if cp is None else cp, game_url[20:])
         else:
             return score
 
 
+class ProbePool:
+    """
+    Engines, each driven by its own `Generator`, analysing several candidate positions of a game at once.
+    The candidates do not depend on each other's outcome, the first puzzle in ply order is kept.
+    All the generators share the transposition table.
+    """
+    def __init__(self, engines: List[SimpleEngine], tt: TranspositionTable):
+        self.engines = engines
+        self.idle: Queue[Generator] = Queue()
+        for engine in engines:
+            self.idle.put(Generator(engine, tt))
+        self.executor = ThreadPoolExecutor(max_workers = len(engines))
+
+    def analyze_position(self, board: Board, prev_score: Score, current_eval: PovScore, tier: int, material: int, game_url: str) -> Union[Puzzle, Score]:
+        generator = self.idle.get()
+        try:
+            return generator.analyze_position(board, prev_score, current_eval, tier, material, game_url)
+        finally:
+            self.idle.put(generator)
+
+    def compute_eval(self, board: Board) -> PovScore:
+        # while the candidates are probed one engine at least stays idle, see `analyze_mainline`
+        generator = self.idle.get()
+        try:
+            return generator.analysis_engine.analyse(board, eval_limit)["score"]
+        finally:
+            self.idle.put(generator)
+
+    def analyze_mainline(self, generator: Generator, game: Mainline, tier: int) -> Optional[Puzzle]:
+        site = game.headers.get("Site", "?")
+        # in ply order, no more than one candidate ahead per engine
+        pending: Deque[Future] = deque()
+        try:
+            for board, prev_score, current_eval, material in candidate_positions(generator, game):
+                pending.append(self.executor.submit(self.analyze_position, board.copy(), prev_score, current_eval, tier, material, site))
+                while pending and (len(pending) >= len(self.engines) or pending[0].done()):
+                    result = pending.popleft().result()
+                    if isinstance(result, Puzzle):
+                        return result
+            while pending:
+                result = pending.popleft().result()
+                if isinstance(result, Puzzle):
+                    return result
+            return None
+        finally:
+            # the candidates after the puzzle are not needed anymore, those already started are left to finish
+            for future in pending:
+                future.cancel()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        for engine in self.engines:
+            engine.close()
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         prog='generator.py',
@@ -243,39 +334,80 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--file", "-f", help="input PGN file", required=True, metavar="FILE.pgn")
     parser.add_argument("--engine", "-e", help="analysis engine", default="stockfish")
     parser.add_argument("--threads", "-t", help="count of cpu threads for engine searches", default="4")
+    parser.add_argument("--hash", help="size in MB of the hash table of each engine", default="1024")
+    parser.add_argument("--workers", "-w", help="count of games analysed in parallel, each by its own engine sharing the threads", default="1")
+    parser.add_argument("--probe-workers", help="count of engines probing the candidate positions of a game concurrently, sharing the threads and hash of the game's engine", default="1")
     parser.add_argument("--skip", help="How many games to skip from the source", default="0")
     parser.add_argument("--verbose", "-v", help="increase verbosity", action="count")
     parser.add_argument("--players", nargs='+', help="A list of players. If set, only generate games in which one of them played")
+    parser.add_argument("--persistent-cache", help="file where engine analysis results are kept between runs", metavar="FILE")
+    parser.add_argument("--cache-size", help="count of positions kept in the cache of engine results, about 1KB each", default=str(util.TT_CAPACITY))
 
     return parser.parse_args()
 
 
-def make_engine(executable: str, threads: int) -> SimpleEngine:
+def make_engine(executable: str, threads: int, hash: int = 1024) -> SimpleEngine:
     engine = SimpleEngine.popen_uci(executable)
-    engine.configure({'Threads': threads})
+    # the engine hash table stays warm from one probe, and one game, to the next:
+    # analyses are never given a `game`, so `ucinewgame` is only sent before the first one
+    engine.configure({'Threads': threads, 'Hash': hash})
     return engine
 
 
-def open_file(file: str):
+def make_engines(executable: str, threads: int, hash: int, probe_workers: int, tt: TranspositionTable) -> Tuple[Optional[SimpleEngine], Optional[ProbePool]]:
+    """
+    Engines of a generator, sharing `threads` and `hash` (MB). With several probe engines, those do all the analysis,
+    including the evals missing from the games, and the generator has no engine of its own.
+    """
+    if probe_workers < 2:
+        return make_engine(executable, threads, hash), None
+    return None, ProbePool([make_engine(executable, max(1, threads // probe_workers), max(16, hash // probe_workers)) for _ in range(probe_workers)], tt)
+
+
+class ZstdReader(io.TextIOWrapper):
+    """
+    Text decompressed by a `zstd -dc` process, closing it raises if the decompression failed
+    (missing or truncated file) rather than the file looking shorter than it is
+    """
+    def __init__(self, file: str):
+        self.file = file
+        self.process = subprocess.Popen(["zstd", "-dcq", file], stdout = subprocess.PIPE, bufsize = 1 << 20)
+        assert self.process.stdout
+        super().__init__(self.process.stdout, encoding = "utf-8")
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        super().close()
+        # closed before the end of the file, zstd is then killed by SIGPIPE and returns a negative code
+        returncode = self.process.wait()
+        if returncode > 0:
+            raise OSError(f"zstd failed to decompress {self.file}, exit code {returncode}")
+
+def open_file(file: str) -> TextIO:
     if file.endswith(".zst"):
-        return zstandard.open(file, "rt")
+        if shutil.which("zstd") is None:
+            import zstandard # type: ignore # optional, only needed without the zstd command
+            return zstandard.open(file, "rt")
+        # decompress in a separate process, off the interpreter running the analysis
+        return ZstdReader(file)
     return open(file)
 
-def post(game: Game, puzzle: Puzzle, name: str, write_h: bool = False) -> None:
+def post(headers: Headers, puzzle: Puzzle, name: str, write_h: bool = False) -> None:
     parent = puzzle.node.parent
     assert parent
     json = {
-        'PuzzleId': game.headers.get("Site", "?")[20:] + str(parent.ply()),
+        'PuzzleId': headers.get("Site", "?")[20:] + str(parent.ply()),
         'Fen': parent.board().fen(),
         'Moves': puzzle.node.uci() + ' ' + ' '.join(map(lambda m : m.uci(), puzzle.moves)),
         'Rating': 1500,
         'RatingDeviation': 80,
         'Popularity': 100,
         'NbPlays': 0,
-        'GameUrl': game.headers.get("Site", "?") + '#' + str(parent.ply()),
+        'GameUrl': headers.get("Site", "?") + '#' + str(parent.ply()),
         'OpeningTags': '',
-        'white': game.headers.get("White", "?"),
-        'black': game.headers.get("Black", "?"),
+        'white': headers.get("White", "?"),
+        'black': headers.get("Black", "?"),
         #'cp': puzzle.cp,
         #'generator_version': self.version,
     }
@@ -287,78 +419,228 @@ def post(game: Game, puzzle: Puzzle, name: str, write_h: bool = False) -> None:
         writer.writerow(json)
     return None
 
+# headers needed to set up the board, filter the games and post the puzzles
+kept_headers = {"Site", "White", "Black", "WhiteTitle", "BlackTitle", "Variant", "SetUp", "FEN"}
+
+class MainlineVisitor(chess.pgn.BaseVisitor[Mainline]):
+    """
+    Collects the mainline moves and evals of the games matching the criterias, without building a game tree.
+    Variations are skipped, so is the whole movetext of the games not matching.
+    """
+    def __init__(self, players: Optional[List[str]] = None):
+        self.players = players
+        self.accepted = False
+        self.matched = 0
+
+    def begin_game(self) -> None:
+        self.mainline = Mainline(Headers())
+        self.accepted = False
+        self.turn = chess.WHITE
+
+    def begin_headers(self) -> Headers:
+        return self.mainline.headers
+
+    def visit_header(self, tagname: str, tagvalue: str) -> None:
+        # the rest of the tags (Opening, TimeControl, clocks...) are never looked at
+        if tagname in kept_headers:
+            self.mainline.headers[tagname] = tagvalue
+
+    def end_headers(self) -> Optional[chess.pgn.SkipType]:
+        headers = self.mainline.headers
+        variant = headers.get("Variant", "Standard")
+        black = headers.get("Black", "?")
+        white = headers.get("White", "?")
+        self.accepted = (
+            (variant == "Standard" or variant == "Chess960") and
+            (self.players is None or black in self.players or white in self.players)
+        )
+        if not self.accepted:
+            return chess.pgn.SKIP
+        self.matched += 1
+        return None
+
+    def visit_board(self, board: Board) -> None:
+        if self.mainline.board is None:
+            self.mainline.board = board.copy()
+
+    def begin_variation(self) -> chess.pgn.SkipType:
+        return chess.pgn.SKIP
+
+    def visit_move(self, board: Board, move: Move) -> None:
+        self.mainline.moves.append((move, None, None))
+        self.turn = not board.turn
+
+    def visit_comment(self, comment: str) -> None:
+        # comments before the first move are about the game, only the first eval of a move counts
+        if self.mainline.moves and self.mainline.moves[-1][1] is None:
+            move = self.mainline.moves[-1][0]
+            eval = parse_eval(comment, self.turn)
+            if eval is not None:
+                self.mainline.moves[-1] = (move, eval, score_key(eval.relative))
+
+    def handle_error(self, error: Exception) -> None:
+        self.mainline.errors.append(error)
+
+    def result(self) -> Mainline:
+        return self.mainline
+
+def find_puzzle(generator: Generator, game: Mainline, tier: int, i: int, source: str) -> Optional[Puzzle]:
+    game_id = game.headers.get("Site", "?")[20:]
+    # logger.info(f'https://lichess.org/{game_id} tier {tier}')
+    try:
+        puzzle = generator.analyze_game(game, tier)
+        if puzzle is not None:
+            logger.info('v%s %s %s knps, tier %s, game %s', version, source, util.avg_knps(), tier, i)
+        return puzzle
+    except Exception as e:
+        logger.error("Exception on %s: %s", game_id, e)
+        return None
+
+# per-process state of the pool workers, set up by `init_worker`
+worker_generator: Optional[Generator] = None
+worker_lock: Optional[Lock] = None
+worker_write_h: Optional[Synchronized] = None
+worker_source = ""
+worker_name = ""
+
+def init_worker(executable: str, threads: int, hash: int, probe_workers: int, entries: MutableMapping, capacity: int, lock: Lock, write_h: Synchronized, source: str, name: str) -> None:
+    global worker_generator, worker_lock, worker_write_h, worker_source, worker_name
+    tt = TranspositionTable(capacity, entries)
+    engine, probes = make_engines(executable, threads, hash, probe_workers, tt)
+    # the engine thread would otherwise keep the worker alive on shutdown
+    if engine is not None:
+        multiprocessing.util.Finalize(None, engine.close, exitpriority = 10)
+    if probes is not None:
+        multiprocessing.util.Finalize(None, probes.close, exitpriority = 10)
+    worker_generator = Generator(engine, tt, probes)
+    worker_lock = lock
+    worker_write_h = write_h
+    worker_source = source
+    worker_name = name
+
+def analyze_game_worker(game: Mainline, tier: int, i: int) -> Tuple[int, int]:
+    """
+    returns the transposition table hits and misses of the game, the counters being per process
+    """
+    assert worker_generator and worker_lock and worker_write_h
+    tt = worker_generator.tt
+    hits, misses = tt.hits, tt.misses
+    puzzle = find_puzzle(worker_generator, game, tier, i, worker_source)
+    if puzzle is not None:
+        # only the csv writes are serialized, `write_h` must be honoured by the first one
+        with worker_lock:
+            post(game.headers, puzzle, worker_name, bool(worker_write_h.value))
+            worker_write_h.value = False
+    return tt.hits - hits, tt.misses - misses
+
 def main() -> None:
-    sys.setrecursionlimit(10000) # else node.deepcopy() sometimes fails?
     args = parse_args()
     #if args.verbose and args.verbose >= 2:
         #logger.setLevel(logging.DEBUG)
     #else:
         #logger.setLevel(logging.INFO)
     logger.setLevel(logging.DEBUG)
-    engine = make_engine(args.engine, args.threads)
-    generator = Generator(engine)
+    workers = int(args.workers)
+    threads = int(args.threads)
+    probe_workers = int(args.probe_workers)
+    capacity = int(args.cache_size)
+    tt = TranspositionTable.load(args.persistent_cache, capacity) if args.persistent_cache else TranspositionTable(capacity)
+    hash = int(args.hash)
+    engine, probes = make_engines(args.engine, threads, hash, probe_workers, tt) if workers == 1 else (None, None)
     file = Path(args.file)
-    games = 0
     site = "?"
     has_master = False
     tier = 10
     skip = int(args.skip)
     write_h = skip > 0 # Erase the .csv file if not skipping any game (i.e starting over), else add
-    logger.info("Skipping first {} games".format(skip))
+    logger.info("Skipping first %s games", skip)
 
     print(f'v{version}')
     players = args.players
+    name = "_".join(players) if players is not None else file.stem
+
+    def snapshot(i: int, shared: Optional[MutableMapping] = None) -> None:
+        if args.persistent_cache and (i + 1) % cache_snapshot_interval == 0:
+            if shared is not None:
+                tt.entries = OrderedDict(shared.items())
+            logger.info("Saving %s cached positions after game %s", len(tt.entries), i)
+            tt.save(args.persistent_cache)
 
     try:
         i = None
         with open_file(args.file) as pgn:
-            filtered_games_offset: List[int] = []
-            while "Look for all headers of the file":
-                offset = pgn.tell()
-                headers = chess.pgn.read_headers(pgn)
-                if skip > 0:
-                    skip -= 1
-                    continue
-                if headers is None:
-                    break
-                games = games + 1
-                if games % 1000 == 0:
-                    logger.info(f"{games} headers parsed")
-                variant = headers.get("Variant", "Standard")
-                black = headers.get("Black", "?")
-                white = headers.get("White", "?")
-                white_title = headers.get("WhiteTitle", "?")
-                black_title = headers.get("BlackTitle", "?")
-                if variant != "Standard" and variant != "Chess960":
-                    continue
-                if players is not None and black not in players and white not in players:
-                    continue
-                filtered_games_offset.append(offset)
-            logger.info(f"All headers parsed, {len(filtered_games_offset)}/{games} games that match the criterias.")
-
-            for i, game_offset in enumerate(filtered_games_offset):
-                pgn.seek(game_offset)
-                game = chess.pgn.read_game(pgn)
-                black = game.headers.get("Black", "?")
-                white = game.headers.get("White", "?")
-                if game.errors:
-                    logger.error(f"Illegal move detected in {white} vs {black}, game {i}")
-                assert(game)
-                game_id = game.headers.get("Site", "?")[20:]
-                # logger.info(f'https://lichess.org/{game_id} tier {tier}')
-                try:
-                    puzzle = generator.analyze_game(game, tier)
+            while skip > 0 and chess.pgn.skip_game(pgn):
+                skip -= 1
+
+            def read_games() -> Iterator[Tuple[int, Mainline]]:
+                # single pass over the file, the movetext of games not matching is skipped unparsed
+                games = 0
+                visitor = MainlineVisitor(players)
+                while "Look for all games of the file":
+                    game = chess.pgn.read_game(pgn, Visitor = lambda: visitor)
+                    if game is None:
+                        break
+                    games = games + 1
+                    if games % 1000 == 0:
+                        logger.info("%s headers parsed", games)
+                    if not visitor.accepted:
+                        continue
+                    i = visitor.matched - 1
+                    if game.errors:
+                        black = game.headers.get("Black", "?")
+                        white = game.headers.get("White", "?")
+                        logger.error("Illegal move detected in %s vs %s, game %s", white, black, i)
+                    yield i, game
+                logger.info("All games parsed, %s/%s games that match the criterias.", visitor.matched, games)
+
+            if workers == 1:
+                generator = Generator(engine, tt, probes)
+                for i, game in read_games():
+                    puzzle = find_puzzle(generator, game, tier, i, args.file)
                     if puzzle is not None:
-                        logger.info(f'v{version} {args.file} {util.avg_knps()} knps, tier {tier}, game {i}')
-                        post(game, puzzle, "_".join(players) if players is not None else file.stem, write_h)
+                        post(game.headers, puzzle, name, write_h)
                         write_h = False
-                except Exception as e:
-                    logger.error("Exception on {}: {}".format(game_id, e))
+                    snapshot(i)
+            else:
+                # games are independent, each worker owns an engine and they all share the transposition table
+                with multiprocessing.Manager() as manager:
+                    entries = manager.dict(tt.entries)
+                    def count(future: Future) -> None:
+                        hits, misses = future.result()
+                        tt.hits += hits
+                        tt.misses += misses
+
+                    try:
+                        with ProcessPoolExecutor(
+                            max_workers = workers,
+                            initializer = init_worker,
+                            initargs = (args.engine, max(1, threads // workers), hash, probe_workers, entries, capacity, multiprocessing.Lock(), multiprocessing.Value('b', write_h), args.file, name)
+                        ) as executor:
+                            pending: Set[Future] = set()
+                            for i, game in read_games():
+                                if len(pending) >= 2 * workers:
+                                    done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                                    for future in done:
+                                        count(future)
+                                pending.add(executor.submit(analyze_game_worker, game, tier, i))
+                                snapshot(i, entries)
+                            for future in pending:
+                                count(future)
+                    finally:
+                        tt.entries = OrderedDict(entries.items())
     except KeyboardInterrupt:
         print(f'v{version} {args.file} Game {i}')
         sys.exit(1)
+    finally:
+        if args.persistent_cache:
+            logger.info("Saving %s cached positions (%s hits, %s misses)", len(tt.entries), tt.hits, tt.misses)
+            tt.save(args.persistent_cache)
+        # an engine left open keeps the process alive, even when leaving on an exception
+        if engine is not None:
+            engine.close()
+        if probes is not None:
+            probes.close()
 
-    engine.close()
     print(f'v{version} {args.file} Game {i}')
 
 if __name__ == "__main__":
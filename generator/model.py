@@ -1,8 +1,8 @@
-from chess.pgn import GameNode, ChildNode
-from chess import Move, Color
-from chess.engine import Score
-from dataclasses import dataclass
-from typing import Tuple, List, Optional
+from chess.pgn import ChildNode, Headers
+from chess import Move, Color, Board
+from chess.engine import Score, PovScore
+from dataclasses import dataclass, field
+from typing import Counter, Hashable, Tuple, List, Optional
 
 @dataclass
 class Puzzle:
@@ -11,6 +11,17 @@ class Puzzle:
     cp: int
     id: str
 
+@dataclass
+class Mainline:
+    """
+    What the generator needs of a game: its starting position, and the mainline moves with the eval after each,
+    also given as `util.score_key` of the side to move
+    """
+    headers: Headers
+    board: Optional[Board] = None
+    moves: List[Tuple[Move, Optional[PovScore], Optional[int]]] = field(default_factory = list)
+    errors: List[Exception] = field(default_factory = list)
+
 @dataclass
 class Line:
     nb: Tuple[int, int]
@@ -24,7 +35,54 @@ class EngineMove:
 
 @dataclass
 class NextMovePair:
-    node: GameNode
     winner: Color
     best: EngineMove
     second: Optional[EngineMove]
+    # answer to `best` in its principal variation
+    expected_reply: Optional[Move] = None
+
+@dataclass
+class ProbeNode:
+    """
+    Line being probed from `board`, which is played forward in place.
+    Positions since the last irreversible move are counted as they are reached,
+    so that repetitions don't need the move stack to be replayed.
+    """
+    board: Board
+    moves: List[Move] = field(default_factory = list)
+    positions: Counter[Hashable] = field(init = False)
+
+    def __post_init__(self) -> None:
+        self.positions = Counter([self.board._transposition_key()])
+        board = self.board.copy()
+        while board.move_stack:
+            move = board.pop()
+            if board.is_irreversible(move):
+                break
+            self.positions[board._transposition_key()] += 1
+
+    def add_main_variation(self, move: Move) -> "ProbeNode":
+        if self.board.is_irreversible(move):
+            self.positions.clear()
+        self.board.push(move)
+        self.moves.append(move)
+        self.positions[self.board._transposition_key()] += 1
+        return self
+
+    def unwind(self) -> None:
+        """takes back all the moves played on `board`"""
+        for _ in self.moves:
+            self.board.pop()
+
+    def is_repetition(self, count: int = 3) -> bool:
+        return self.positions[self.board._transposition_key()] >= count
+
+@dataclass
+class TTEntry:
+    # scores are relative to the side to move
+    best: EngineMove
+    second: Optional[EngineMove]
+    # depth and nodes of the limit searched with
+    depth: Optional[int]
+    nodes: Optional[int]
+    reply: Optional[Move] = None
@@ -1,23 +1,30 @@
 import unittest
 import logging
+import os
+import random
+import tempfile
+import time
 import chess
-from model import Puzzle
+import chess.engine
+from model import EngineMove, Mainline, ProbeNode, Puzzle, TTEntry
 from generator import logger
-from server import Server
 from chess.engine import SimpleEngine, Mate, Cp, Score, PovScore
 from chess import Move, Color, Board, WHITE, BLACK
-from chess.pgn import Game, GameNode
-from typing import List, Optional, Tuple, Literal, Union
+from chess.pgn import Game, GameNode, Headers
+from io import StringIO
+from typing import List, Optional, Set, Tuple, Literal, Union
+from unittest import mock
 
-from generator import Generator, Server, make_engine
+from analyze_core import analyze_mainline
+from generator import Generator, MainlineVisitor, ProbePool, make_engine, puzzle_node
+from util import get_next_move_pair, material_change, material_count, material_diff, score_key, TranspositionTable
 
 class TestGenerator(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
         cls.engine = make_engine("stockfish", 6) # don't use more than 6 threads! it fails at finding mates
-        cls.server = Server(logger, "", "", 0)
-        cls.gen = Generator(cls.engine, cls.server)
+        cls.gen = Generator(cls.engine)
         logger.setLevel(logging.DEBUG)
 
     def test_puzzle_1(self) -> None:
@@ -156,7 +163,7 @@ class TestGenerator(unittest.TestCase):
 
     def test_not_puzzle_17(self) -> None:
         with open("test_pgn_3fold_uDMCM.pgn") as pgn:
-            game = chess.pgn.read_game(pgn)
+            game = chess.pgn.read_game(pgn, Visitor=MainlineVisitor)
             puzzle = self.gen.analyze_game(game, tier=10)
             self.assertEqual(puzzle, None)
 
@@ -165,7 +172,7 @@ class TestGenerator(unittest.TestCase):
         game = Game.from_board(board)
         node = game.add_main_variation(Move.from_uci(move))
         current_eval = PovScore(current_score, not board.turn)
-        result = self.gen.analyze_position(node, prev_score, current_eval, tier=10)
+        result = self.gen.analyze_position(node.board(), prev_score, current_eval, tier=10)
         self.assert_is_puzzle_with_moves(result, [Move.from_uci(x) for x in moves.split()])
 
 
@@ -174,7 +181,7 @@ class TestGenerator(unittest.TestCase):
         game = Game.from_board(board)
         node = game.add_main_variation(Move.from_uci(move))
         current_eval = PovScore(current_score, not board.turn)
-        result = self.gen.analyze_position( node, prev_score, current_eval, tier=10)
+        result = self.gen.analyze_position(node.board(), prev_score, current_eval, tier=10)
         self.assertIsInstance(result, Score)
 
 
@@ -188,5 +195,237 @@ class TestGenerator(unittest.TestCase):
         cls.engine.close()
 
 
+class TestMainlineVisitor(unittest.TestCase):
+
+    def test_3fold(self) -> None:
+        # eval-less first comment on 12. Ne3?, variations
+        with open("test_pgn_3fold_uDMCM.pgn") as pgn:
+            self.assert_same_mainline(pgn.read())
+
+    def test_chess960(self) -> None:
+        self.assert_same_mainline("""[Site "https://lichess.org/abcdefgh"]
+[Variant "Chess960"]
+[SetUp "1"]
+[FEN "bnrkqnrb/pppppppp/8/8/8/8/PPPPPPPP/BNRKQNRB w KQkq - 0 1"]
+
+1. O-O-O { [%eval 0.19] } 1... O-O-O { [%eval -0.74] } (1... e5 2. e4) 2. a4 { [%eval -0.05] } 2... b5 { [%eval -0.87] } 3. Ng3 { [%eval 0.82] } 3... e6 *
+""")
+
+    def test_mated(self) -> None:
+        self.assert_same_mainline("""[Site "https://lichess.org/abcdefgh"]
+
+1. f3 { [%eval -0.5] } 1... e5 { [%eval -0.6] } 2. g4 { [%eval #-1] } 2... Qh4# { [%eval #0] } 0-1
+""")
+
+    def assert_same_mainline(self, pgn: str) -> None:
+        mainline = chess.pgn.read_game(StringIO(pgn), Visitor=MainlineVisitor)
+        game = chess.pgn.read_game(StringIO(pgn))
+        assert mainline and mainline.board and game
+        self.assertEqual(mainline.board, game.board())
+        self.assertEqual(mainline.board.chess960, game.board().chess960)
+        nodes = list(game.mainline())
+        self.assertEqual([move for move, _, _ in mainline.moves], [node.move for node in nodes])
+        for (_, eval, key), node in zip(mainline.moves, nodes):
+            expected = node.eval()
+            self.assertEqual(eval, expected)
+            if eval and expected:
+                self.assertEqual(eval.turn, expected.turn)
+            self.assertEqual(key, None if eval is None else score_key(eval.relative))
+
+
+class TestProbeNode(unittest.TestCase):
+
+    def test_repetition(self) -> None:
+        # knights going back and forth, before and while probing, across an irreversible move
+        board = Board()
+        for uci in "g1f3 g8f6 f3g1 f6g8".split():
+            board.push_uci(uci)
+        fen = board.fen()
+        probe = ProbeNode(board)
+        for uci in "g1f3 g8f6 f3g1 f6g8 g1f3 g8f6 e2e4 b8c6 f3g1 c6b8 g1f3 b8c6 f3g1 c6b8 g1f3".split():
+            probe.add_main_variation(Move.from_uci(uci))
+            for count in (2, 3):
+                self.assertEqual(probe.is_repetition(count), board.is_repetition(count), (board.fen(), count))
+        probe.unwind()
+        self.assertEqual(board.fen(), fen)
+
+
+class StubEngine:
+    """
+    Stands for stockfish, always finding the same two moves with the same scores, relative to the side to move
+    """
+    def __init__(self, best: Score = Cp(100), second: Score = Cp(-50)):
+        self.best = best
+        self.second = second
+        self.analyses = 0
+
+    def analyse(self, board: Board, limit: chess.engine.Limit, multipv: Optional[int] = None, **kwargs) -> Union[dict, List[dict]]:
+        self.analyses += 1
+        moves = list(board.legal_moves)
+        if multipv is None:
+            return { "pv": [moves[0]], "score": PovScore(self.best, board.turn) }
+        return [
+            { "pv": [moves[0]], "score": PovScore(self.best, board.turn), "nps": 1000, "nodes": 1000 },
+            { "pv": [moves[1]], "score": PovScore(self.second, board.turn), "nps": 1000, "nodes": 1000 },
+        ]
+
+    def close(self) -> None:
+        pass
+
+
+def tt_entry(depth: Optional[int] = 20, nodes: Optional[int] = 1000) -> TTEntry:
+    return TTEntry(EngineMove(Move.from_uci("e2e4"), Cp(100)), None, depth, nodes)
+
+
+class TestTranspositionTable(unittest.TestCase):
+
+    limit = chess.engine.Limit(depth = 20)
+
+    def test_lru_eviction(self) -> None:
+        tt = TranspositionTable(3)
+        for key in range(3):
+            tt.put(key, tt_entry())
+        # a hit makes the entry the most recently used one
+        self.assertIsNotNone(tt.get(0, self.limit))
+        self.assertEqual(list(tt.entries), [1, 2, 0])
+        tt.put(3, tt_entry())
+        tt.put(4, tt_entry())
+        self.assertEqual(list(tt.entries), [0, 3, 4])
+        self.assertIsNone(tt.get(1, self.limit))
+        self.assertEqual((tt.hits, tt.misses), (1, 1))
+
+    def test_shared_eviction(self) -> None:
+        # a mapping shared between processes, each having its own table
+        tt = TranspositionTable(3, {})
+        for key in range(10):
+            tt.put(key, tt_entry())
+        self.assertEqual(sorted(tt.entries), [7, 8, 9])
+        # stored again, not a new entry
+        tt.put(8, tt_entry())
+        self.assertEqual(sorted(tt.entries), [7, 8, 9])
+        entries: dict = {}
+        tables = [TranspositionTable(3, entries), TranspositionTable(3, entries)]
+        for key in range(10):
+            tables[key % 2].put(key, tt_entry())
+            self.assertLessEqual(len(entries), 3)
+            self.assertIn(key, entries)
+            self.assertIn(key - 1 if key else key, entries)
+        # entries already there when the table is made are evicted first
+        table = TranspositionTable(3, { key: tt_entry() for key in range(3) })
+        table.put(3, tt_entry())
+        table.put(4, tt_entry())
+        self.assertEqual(sorted(table.entries), [2, 3, 4])
+
+    def test_load_trims(self) -> None:
+        tt = TranspositionTable(10)
+        for key in range(10):
+            tt.put(key, tt_entry())
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "cache.pickle")
+            tt.save(path)
+            loaded = TranspositionTable.load(path, 4)
+            self.assertEqual(list(loaded.entries), [6, 7, 8, 9])
+            self.assertEqual(loaded.capacity, 4)
+            self.assertEqual(len(TranspositionTable.load(os.path.join(dir, "missing.pickle")).entries), 0)
+
+    def test_depth(self) -> None:
+        tt = TranspositionTable()
+        tt.put(0, tt_entry(20))
+        self.assertIsNone(tt.get(0, chess.engine.Limit(depth = 35)))
+        self.assertIsNotNone(tt.get(0, chess.engine.Limit(depth = 15)))
+        tt.put(1, tt_entry(None))
+        self.assertIsNone(tt.get(1, chess.engine.Limit(depth = 15)))
+
+    def test_nodes(self) -> None:
+        # same depth as `pair_limit`, searched with fewer nodes
+        tt = TranspositionTable()
+        tt.put(0, tt_entry(50, 18_000_000))
+        self.assertIsNone(tt.get(0, chess.engine.Limit(depth = 50, nodes = 30_000_000)))
+        self.assertIsNotNone(tt.get(0, chess.engine.Limit(depth = 50, nodes = 18_000_000)))
+        self.assertIsNotNone(tt.get(0, chess.engine.Limit(depth = 35, nodes = 10_000_000)))
+        tt.put(1, tt_entry(50, None))
+        self.assertIsNone(tt.get(1, chess.engine.Limit(depth = 50, nodes = 10_000_000)))
+
+    def test_next_move_pair(self) -> None:
+        engine = StubEngine(Cp(100), Cp(-50))
+        tt = TranspositionTable()
+        board = Board()
+        pair = get_next_move_pair(engine, board, WHITE, chess.engine.Limit(depth = 20), tt) # type: ignore
+        self.assertEqual((pair.best.score, pair.second and pair.second.score), (Cp(100), Cp(-50)))
+        # same position, analysed for the other side
+        pair = get_next_move_pair(engine, board, BLACK, chess.engine.Limit(depth = 20), tt) # type: ignore
+        self.assertEqual(engine.analyses, 1)
+        self.assertEqual((pair.best.score, pair.second and pair.second.score), (Cp(-100), Cp(50)))
+        self.assertEqual(pair.winner, BLACK)
+        # not searched deep enough
+        get_next_move_pair(engine, board, WHITE, chess.engine.Limit(depth = 35), tt) # type: ignore
+        self.assertEqual(engine.analyses, 2)
+        entry = tt.entries[board._transposition_key()]
+        self.assertEqual((entry.depth, entry.nodes), (35, None))
+
+
+class TestProbePool(unittest.TestCase):
+
+    def test_first_puzzle(self) -> None:
+        # the candidates take random times to probe, the puzzle kept is still the first in ply order
+        rng = random.Random(0)
+        mainline = self.mainline(rng)
+        puzzle_plies: Set[int] = set()
+
+        def analyze_position(generator: Generator, board: Board, prev_score: Score, current_eval: PovScore, tier: int, material: Optional[int] = None, game_url: str = "?") -> Union[Puzzle, Score]:
+            time.sleep(random.random() / 200)
+            if board.ply() in puzzle_plies:
+                return Puzzle(puzzle_node(board), [], board.ply(), game_url)
+            return current_eval.pov(board.turn)
+
+        pool = ProbePool([StubEngine(Cp(300)) for _ in range(4)], TranspositionTable()) # type: ignore
+        generator = Generator(None, probes = pool)
+        try:
+            with mock.patch.object(Generator, "analyze_position", analyze_position):
+                plies = list(range(1, len(mainline.moves) + 1))
+                for puzzle_plies in [set(), { 1 }, { len(mainline.moves) }] + [set(rng.sample(plies, k)) for k in (1, 1, 2, 3, 5, 10)]:
+                    expected = analyze_mainline(generator, mainline, 10)
+                    puzzle = pool.analyze_mainline(generator, mainline, 10)
+                    self.assertEqual(puzzle and puzzle.cp, expected and expected.cp, puzzle_plies)
+                    self.assertEqual(expected is None, not puzzle_plies)
+        finally:
+            pool.close()
+
+    def mainline(self, rng: random.Random) -> Mainline:
+        # kings and rooks don't move, so that castling rights stay those of the position.
+        # half of the moves have no eval, it is then computed by the engines of the pool
+        board = Board()
+        mainline = Mainline(Headers(), board.copy())
+        while board.ply() < 60:
+            moves = [move for move in board.legal_moves if board.piece_type_at(move.from_square) not in (chess.KING, chess.ROOK) and move.promotion in (None, chess.QUEEN)]
+            if not moves:
+                break
+            move = rng.choice(moves)
+            board.push(move)
+            eval = PovScore(Cp(300), board.turn) if board.ply() % 2 else None
+            mainline.moves.append((move, eval, score_key(eval.relative) if eval else None))
+        return mainline
+
+
+class TestUtil(unittest.TestCase):
+
+    def test_material_change(self) -> None:
+        # random games, castling and taking en passant whenever possible, also go through promotions with captures
+        rng = random.Random(0)
+        for i in range(100):
+            board = Board.from_chess960_pos(rng.randrange(960)) if i % 2 else Board()
+            material = { WHITE: material_count(board, WHITE), BLACK: material_count(board, BLACK) }
+            moves = list(board.legal_moves)
+            while moves and board.ply() < 300:
+                special = [move for move in moves if board.is_castling(move) or board.is_en_passant(move)]
+                move = special[0] if special else rng.choice(moves)
+                won, lost = material_change(board, move)
+                material[board.turn] += won
+                material[not board.turn] -= lost
+                board.push(move)
+                self.assertEqual(material[board.turn] - material[not board.turn], material_diff(board, board.turn), board.fen())
+                moves = list(board.legal_moves)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,25 +1,40 @@
+from collections import OrderedDict, deque
 from dataclasses import dataclass
 import math
+import os
+import pickle
+import threading
 import chess
 import chess.engine
-from model import EngineMove, NextMovePair
-from chess import Color, Board
-from chess.pgn import GameNode
-from chess.engine import SimpleEngine, Score
-from typing import Optional
+import chess.pgn
+from model import EngineMove, NextMovePair, TTEntry
+from chess import Color, Board, Move
+from chess.engine import SimpleEngine, Score, PovScore
+from typing import Deque, Hashable, List, MutableMapping, Optional, Tuple
 
-nps = []
+nps: List[float] = []
+
+values = { chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9 }
 
 def material_count(board: Board, side: Color) -> int:
-    values = { chess.PAWN: 1, chess.KNIGHT: 3, chess.BISHOP: 3, chess.ROOK: 5, chess.QUEEN: 9 }
     return sum(len(board.pieces(piece_type, side)) * value for piece_type, value in values.items())
 
+def material_change(board: Board, move: Move) -> Tuple[int, int]:
+    """
+    material won by the side to move through promotion, and lost by the opponent, when `move` is played
+    """
+    won = values[move.promotion] - values[chess.PAWN] if move.promotion else 0
+    if board.is_en_passant(move):
+        return won, values[chess.PAWN]
+    captured = board.piece_at(move.to_square)
+    # chess960 castling is encoded as the king taking its own rook
+    if captured is None or captured.color == board.turn:
+        return won, 0
+    return won, values.get(captured.piece_type, 0)
+
 def material_diff(board: Board, side: Color) -> int:
     return material_count(board, side) - material_count(board, not side)
 
-def is_up_in_material(board: Board, side: Color) -> bool:
-    return material_diff(board, side) > 0
-
 def maximum_castling_rights(board: chess.Board) -> chess.Bitboard:
     return (
         (board.pieces_mask(chess.ROOK, chess.WHITE) & (chess.BB_A1 | chess.BB_H1) if board.king(chess.WHITE) == chess.E1 else chess.BB_EMPTY) |
@@ -27,17 +42,103 @@ def maximum_castling_rights(board: chess.Board) -> chess.Bitboard:
     )
 
 
-def get_next_move_pair(engine: SimpleEngine, node: GameNode, winner: Color, limit: chess.engine.Limit) -> NextMovePair:
-    info = engine.analyse(node.board(), multipv = 2, limit = limit)
-    global nps
-    nps.append(info[0]["nps"] / 1000)
-    nps = nps[-10000:]
-    # print(info)
-    best = EngineMove(info[0]["pv"][0], info[0]["score"].pov(winner))
-    second = EngineMove(info[1]["pv"][0], info[1]["score"].pov(winner)) if len(info) > 1 else None
-    return NextMovePair(node, winner, best, second)
-
-def avg_knps():
+# entries are python objects of about 1KB each, not the few bytes of an engine hash entry
+TT_CAPACITY = 500_000
+
+class TranspositionTable:
+    """
+    Engine results shared across games, keyed by `board._transposition_key()`.
+    Least recently used entries are evicted once `capacity` is reached. `entries` can be
+    a mapping shared between processes, which is not kept in LRU order: each process then
+    evicts the oldest entries it stored.
+    Lookups and stores can come from several threads probing at once.
+    """
+    def __init__(self, capacity: int = TT_CAPACITY, entries: Optional[MutableMapping[Hashable, TTEntry]] = None):
+        self.capacity = capacity
+        self.entries: MutableMapping[Hashable, TTEntry] = OrderedDict() if entries is None else entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # keys stored by this process in a shared `entries`, oldest first
+        self.stored: Deque[Hashable] = deque()
+
+    def get(self, key: Hashable, limit: chess.engine.Limit) -> Optional[TTEntry]:
+        with self.lock:
+            entry = self.entries.get(key)
+            # only a search at least as deep, and given at least as many nodes, answers `limit`
+            if entry is None or (
+                (limit.depth is not None and (entry.depth is None or entry.depth < limit.depth)) or
+                (limit.nodes is not None and (entry.nodes is None or entry.nodes < limit.nodes))
+            ):
+                self.misses += 1
+                return None
+            if isinstance(self.entries, OrderedDict):
+                self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Hashable, entry: TTEntry) -> None:
+        with self.lock:
+            if isinstance(self.entries, OrderedDict):
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.capacity:
+                    self.entries.popitem(last = False)
+                return
+            if key not in self.entries:
+                while len(self.entries) >= self.capacity:
+                    if not self.stored:
+                        # full of entries loaded or stored by other processes, in their order of insertion
+                        self.stored.extend(self.entries.keys())
+                    # possibly evicted by another process already
+                    self.entries.pop(self.stored.popleft(), None)
+                self.stored.append(key)
+            self.entries[key] = entry
+
+    def save(self, path: str) -> None:
+        # written aside then renamed, an interrupted save leaves the previous file untouched
+        tmp = path + ".tmp"
+        with self.lock, open(tmp, "wb") as f:
+            pickle.dump(self.entries, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, capacity: int = TT_CAPACITY) -> "TranspositionTable":
+        tt = cls(capacity)
+        try:
+            with open(path, "rb") as f:
+                entries = pickle.load(f)
+        except FileNotFoundError:
+            return tt
+        # saved with a larger capacity, the least recently used entries come first
+        tt.entries = OrderedDict(entries)
+        while len(tt.entries) > capacity:
+            tt.entries.popitem(last = False)
+        return tt
+
+
+def get_next_move_pair(engine: SimpleEngine, board: Board, winner: Color, limit: chess.engine.Limit, tt: Optional[TranspositionTable] = None) -> NextMovePair:
+    key = board._transposition_key()
+    entry = tt.get(key, limit) if tt is not None else None
+    if entry is None:
+        info = engine.analyse(board, multipv = 2, limit = limit)
+        global nps
+        nps.append(info[0]["nps"] / 1000)
+        nps = nps[-10000:]
+        # print(info)
+        entry = TTEntry(
+            EngineMove(info[0]["pv"][0], info[0]["score"].relative),
+            EngineMove(info[1]["pv"][0], info[1]["score"].relative) if len(info) > 1 else None,
+            limit.depth,
+            limit.nodes,
+            info[0]["pv"][1] if len(info[0]["pv"]) > 1 else None)
+        if tt is not None:
+            tt.put(key, entry)
+    best = EngineMove(entry.best.move, PovScore(entry.best.score, board.turn).pov(winner))
+    second = EngineMove(entry.second.move, PovScore(entry.second.score, board.turn).pov(winner)) if entry.second else None
+    return NextMovePair(winner, best, second, entry.reply)
+
+def avg_knps() -> int:
     global nps
     return round(sum(nps) / len(nps)) if nps else 0
 
@@ -50,8 +151,46 @@ def win_chances(score: Score) -> float:
         return 1 if mate > 0 else -1
 
     cp = score.score()
+    if cp is None:
+        return 0
+    if -WIN_CHANCES_RANGE <= cp <= WIN_CHANCES_RANGE:
+        return win_chances_table[cp + WIN_CHANCES_RANGE]
+    return raw_win_chances(cp)
+
+def raw_win_chances(cp: int) -> float:
     MULTIPLIER = -0.00368208 # https://github.com/lichess-org/lila/pull/11148
-    return 2 / (1 + math.exp(MULTIPLIER * cp)) - 1 if cp is not None else 0
+    return 2 / (1 + math.exp(MULTIPLIER * cp)) - 1
+
+# centipawns evals are integers, precompute the usual ones
+WIN_CHANCES_RANGE = 4000
+win_chances_table = [raw_win_chances(cp) for cp in range(-WIN_CHANCES_RANGE, WIN_CHANCES_RANGE + 1)]
+
+MATE_SCORE = 100_000
+
+def score_key(score: Score) -> int:
+    """
+    `score` as an int ordered the same way, a mate in n being worth `MATE_SCORE - n`
+    """
+    return score.score(mate_score = MATE_SCORE)
+
+def parse_eval(comment: str, turn: Color) -> Optional[PovScore]:
+    """
+    First `[%eval ...]` of a move comment, `turn` being the side to move after it. Same as `chess.pgn.GameNode.eval`
+    """
+    match = chess.pgn.EVAL_REGEX.search(comment)
+    if not match:
+        return None
+
+    if match.group(1):
+        mate = int(match.group(1))
+        score: Score = chess.engine.Mate(mate)
+        if mate == 0:
+            # the player to move after mate is the player who has been mated
+            return PovScore(score, turn)
+    else:
+        score = chess.engine.Cp(int(float(match.group(2)) * 100))
+
+    return PovScore(score if turn else -score, turn)
 
 def time_control_tier(line: str) -> Optional[int]:
     if not line.startswith("[TimeControl "):
@@ -69,14 +208,20 @@ def time_control_tier(line: str) -> Optional[int]:
     except:
         return 0
     
-def count_mates(board:chess.Board) -> int:
-    mates = 0
+def non_mating_moves(board: chess.Board) -> List[Move]:
+    moves = []
     for move in board.legal_moves:
         board.push(move)
-        if board.is_checkmate():
-            mates += 1
+        if not board.is_checkmate():
+            moves.append(move)
         board.pop()
-    return mates
+    return moves
+
+def at_least_two_legal(board: chess.Board) -> bool:
+    # stops generating legal moves as soon as a second one is found
+    moves = iter(board.legal_moves)
+    next(moves, None)
+    return next(moves, None) is not None
 
 def rating_tier(line: str) -> Optional[int]:
     if not line.startswith("[WhiteElo ") and not line.startswith("[BlackElo "):